@@ -1,11 +1,34 @@
+from sqlalchemy import event, text
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
 from models import Base
+import logging
 
 DATABASE_URL = "sqlite+aiosqlite:///./test.db"
 engine = create_async_engine(DATABASE_URL, future=True, echo=False)
 SessionLocal = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
+# В режиме WAL читатели не мешают фиксации пишущей транзакции, поэтому
+# запросы API дожидаются BEGIN IMMEDIATE пересчёта статистики, а не падают.
+@event.listens_for(engine.sync_engine, "connect")
+def set_sqlite_journal_mode(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.close()
+
 async def get_session_local() -> AsyncSession:
     async with SessionLocal() as session:
-        yield session
\ No newline at end of file
+        yield session
+
+ADDED_COLUMNS = [
+    ("auditorium_state", "locked_at", "DATETIME"),
+]
+
+async def ensure_added_columns(conn):
+    # create_all не добавляет колонки в существующие таблицы.
+    for table, column, column_type in ADDED_COLUMNS:
+        result = await conn.execute(text(f"PRAGMA table_info({table})"))
+        columns = [row[1] for row in result]
+        if column not in columns:
+            await conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}"))
+            logging.info(f"В таблицу {table} добавлена колонка {column}")
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Boolean, Integer, DateTime
+from sqlalchemy import Column, String, Boolean, Integer, Float, DateTime, UniqueConstraint
 import uuid
 from datetime import datetime
 from sqlalchemy.orm import DeclarativeMeta, declarative_base
@@ -18,3 +18,25 @@ class AuditoriumState(Base):
     auditorium_number = Column(Integer, unique=True, index=True, nullable=False)
     is_network_on = Column(Boolean, default=True, nullable=False)
     unlock_time = Column(DateTime, nullable=True)
+    locked_at = Column(DateTime, nullable=True)
+
+class AuditoriumEvent(Base):
+    __tablename__ = "auditorium_event"
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    auditorium_number = Column(Integer, index=True, nullable=False)
+    event = Column(String, nullable=False)
+    reason = Column(String, nullable=True)
+    timestamp = Column(DateTime, index=True, nullable=False, default=datetime.utcnow)
+
+class AuditoriumUsageStats(Base):
+    __tablename__ = "auditorium_usage_stats"
+    __table_args__ = (UniqueConstraint("auditorium_number", "bucket", "bucket_start"),)
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    auditorium_number = Column(Integer, index=True, nullable=False)
+    bucket = Column(String, nullable=False)
+    bucket_start = Column(DateTime, index=True, nullable=False)
+    locked_seconds = Column(Float, default=0, nullable=False)
+    locks = Column(Integer, default=0, nullable=False)
+    auto_unlocks = Column(Integer, default=0, nullable=False)
+    manual_unlocks = Column(Integer, default=0, nullable=False)
+    restore_unlocks = Column(Integer, default=0, nullable=False)
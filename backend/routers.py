@@ -1,64 +1,73 @@
-from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks
+from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from models import AuditoriumState
-from schemas import Auditorium, AuditoriumStateRead
+from models import AuditoriumState, AuditoriumUsageStats
+from schemas import Auditorium, AuditoriumStateRead, AuditoriumStatsRead
 from database import get_session_local
-from utils import run_ansible_playbook, auto_unlock_network
-from typing import List
+from utils import run_ansible_playbook, firewall_operation, auditorium_lock, schedule_auto_unlock, mark_unlocked
+from stats import bucket_start, bucket_length, record_lock
+from typing import List, Literal, Optional
 from datetime import datetime, timedelta
 import logging
 
 router = APIRouter()
 
 @router.post("/auditoriums/lock")
-async def lock_auditorium(auditorium: Auditorium, background_tasks: BackgroundTasks, session: AsyncSession = Depends(get_session_local)):
-    await run_ansible_playbook("firewall.yml", auditorium_number=auditorium.number, class_number=auditorium.number, state="disabled")
-
-    unlock_time = datetime.utcnow() + timedelta(minutes=auditorium.duration)
-    unlock_time_str = unlock_time.strftime("%H:%M:%S") 
-
-    async with session.begin():
-        result = await session.execute(
-            select(AuditoriumState)
-            .where(AuditoriumState.auditorium_number == auditorium.number)
-            .execution_options(populate_existing=True)
-        )
-        existing_state = result.scalar_one_or_none()
-
-        if existing_state:
-            existing_state.is_network_on = False
-            existing_state.unlock_time = unlock_time
-        else:
-            new_state = AuditoriumState(
-                auditorium_number=auditorium.number,
-                is_network_on=False,
-                unlock_time=unlock_time,
+async def lock_auditorium(auditorium: Auditorium, session: AsyncSession = Depends(get_session_local)):
+    async with firewall_operation(), auditorium_lock(auditorium.number):
+        await run_ansible_playbook("firewall.yml", auditorium_number=auditorium.number, class_number=auditorium.number, state="disabled")
+
+        now = datetime.utcnow()
+        unlock_time = now + timedelta(minutes=auditorium.duration)
+        unlock_time_str = unlock_time.strftime("%H:%M:%S") 
+
+        async with session.begin():
+            result = await session.execute(
+                AuditoriumState.__table__.update()
+                .where(AuditoriumState.auditorium_number == auditorium.number)
+                .where(AuditoriumState.is_network_on.is_(True))
+                .values(is_network_on=False, unlock_time=unlock_time, locked_at=now)
             )
-            session.add(new_state)
 
-        await session.commit()
+            if result.rowcount:
+                await record_lock(session, auditorium.number, now)
+            else:
+                # Аудитория уже заблокирована: продлеваем блокировку, не меняя locked_at.
+                result = await session.execute(
+                    AuditoriumState.__table__.update()
+                    .where(AuditoriumState.auditorium_number == auditorium.number)
+                    .values(is_network_on=False, unlock_time=unlock_time)
+                )
+                if not result.rowcount:
+                    new_state = AuditoriumState(
+                        auditorium_number=auditorium.number,
+                        is_network_on=False,
+                        unlock_time=unlock_time,
+                        locked_at=now,
+                    )
+                    session.add(new_state)
+                    await record_lock(session, auditorium.number, now)
 
-    background_tasks.add_task(auto_unlock_network, auditorium)
+            await session.commit()
+
+    schedule_auto_unlock(auditorium.number)
     return {"message": f"Аудитория номер {auditorium.number} заблокирована до {unlock_time_str}"}
 
 @router.post("/auditoriums/unlock")
 async def unlock_auditorium(auditorium: Auditorium, session: AsyncSession = Depends(get_session_local)):
-    await run_ansible_playbook("firewall.yml", auditorium_number=auditorium.number, class_number=auditorium.number, state="enabled")
+    async with firewall_operation(), auditorium_lock(auditorium.number):
+        await run_ansible_playbook("firewall.yml", auditorium_number=auditorium.number, class_number=auditorium.number, state="enabled")
 
-    async with session.begin():
-        await session.execute(
-            AuditoriumState.__table__.update()
-            .where(AuditoriumState.auditorium_number == auditorium.number)
-            .values(is_network_on=True, unlock_time=None)
-        )
-        await session.commit()
+        async with session.begin():
+            await mark_unlocked(session, auditorium.number, "manual")
+            await session.commit()
 
     return {"message": f"Аудитория номер {auditorium.number} успешно разблокирована"}
 
 @router.post("/auditoriums/configure")
 async def configure_auditorium(auditorium: Auditorium, class_number: int, state: str, session: AsyncSession = Depends(get_session_local)):
-    await run_ansible_playbook("firewall.yml", auditorium_number=auditorium.number, class_number=class_number, state=state)
+    async with firewall_operation(), auditorium_lock(auditorium.number):
+        await run_ansible_playbook("firewall.yml", auditorium_number=auditorium.number, class_number=class_number, state=state)
     return {"message": f"Аудитория номер {auditorium.number} настроена с классом {class_number} и состоянием {state}"}
 
 @router.get("/auditoriums/status", response_model=List[AuditoriumStateRead])
@@ -67,34 +76,67 @@ async def get_auditoriums_status(session: AsyncSession = Depends(get_session_loc
     auditoriums = result.scalars().all()
     return auditoriums
 
+@router.get("/auditoriums/stats", response_model=List[AuditoriumStatsRead])
+async def get_auditoriums_stats(bucket: Literal["day", "week"] = "day", date: Optional[datetime] = None, session: AsyncSession = Depends(get_session_local)):
+    now = datetime.utcnow()
+    start = bucket_start(date or now, bucket)
+    end = start + bucket_length(bucket)
+
+    result = await session.execute(
+        select(AuditoriumUsageStats)
+        .where(AuditoriumUsageStats.bucket == bucket)
+        .where(AuditoriumUsageStats.bucket_start == start)
+    )
+    stats_by_number = {stats.auditorium_number: stats for stats in result.scalars().all()}
+
+    result = await session.execute(select(AuditoriumState))
+    response = []
+    for auditorium_state in result.scalars().all():
+        stats = stats_by_number.get(auditorium_state.auditorium_number)
+        locked_seconds = stats.locked_seconds if stats else 0
+
+        # Текущая блокировка попадает в агрегаты только при разблокировке, поэтому добавляем её часть вручную.
+        if not auditorium_state.is_network_on and auditorium_state.locked_at:
+            locked_seconds += max((min(now, end) - max(auditorium_state.locked_at, start)).total_seconds(), 0)
+
+        response.append(AuditoriumStatsRead(
+            auditorium_number=auditorium_state.auditorium_number,
+            bucket=bucket,
+            bucket_start=start,
+            locked_hours=round(locked_seconds / 3600, 2),
+            locks=stats.locks if stats else 0,
+            auto_unlocks=stats.auto_unlocks if stats else 0,
+            manual_unlocks=stats.manual_unlocks if stats else 0,
+            restore_unlocks=stats.restore_unlocks if stats else 0,
+        ))
+    return response
+
 @router.post("/auditoriums/check_and_restore")
 async def check_and_restore_network(session: AsyncSession = Depends(get_session_local)):
     logging.info("Запуск проверки состояния аудиторий через Ansible...")
 
-    output = await run_ansible_playbook("firewall.yml", auditorium_number=None, class_number=None, state=None)
+    async with firewall_operation():
+        output = await run_ansible_playbook("firewall.yml", auditorium_number=None, class_number=None, state=None)
 
-    blocked_auditoriums = []
-    for line in output.split("\n"):
-        if line.strip().isdigit(): 
-            blocked_auditoriums.append(int(line.strip()))
+        blocked_auditoriums = []
+        for line in output.split("\n"):
+            if line.strip().isdigit(): 
+                blocked_auditoriums.append(int(line.strip()))
 
-    if not blocked_auditoriums:
-        return {"message": "Все аудитории уже с сетью."}
+        if not blocked_auditoriums:
+            return {"message": "Все аудитории уже с сетью."}
 
-    logging.info(f"Найдено {len(blocked_auditoriums)} заблокированных аудиторий: {blocked_auditoriums}")
+        logging.info(f"Найдено {len(blocked_auditoriums)} заблокированных аудиторий: {blocked_auditoriums}")
 
-    restored_auditoriums = []
-    for class_number in blocked_auditoriums:
-        await run_ansible_playbook("firewall.yml", auditorium_number=class_number, class_number=class_number, state="disabled")
-        restored_auditoriums.append(class_number)
+        restored_auditoriums = []
+        for class_number in blocked_auditoriums:
+            async with auditorium_lock(class_number):
+                await run_ansible_playbook("firewall.yml", auditorium_number=class_number, class_number=class_number, state="disabled")
+                restored_auditoriums.append(class_number)
 
-        async with session.begin():
-            await session.execute(
-                AuditoriumState.__table__.update()
-                .where(AuditoriumState.auditorium_number == class_number)
-                .values(is_network_on=True, unlock_time=None)
-            )
-            await session.commit()
+                async with session.begin():
+                    await mark_unlocked(session, class_number, "restore")
+                    await session.commit()
 
     return {
         "message": "Проверка завершена.",
@@ -25,6 +25,16 @@ class AuditoriumStateRead(BaseModel):
     class Config:
         from_attributes = True
 
+class AuditoriumStatsRead(BaseModel):
+    auditorium_number: int
+    bucket: str
+    bucket_start: datetime
+    locked_hours: float
+    locks: int
+    auto_unlocks: int
+    manual_unlocks: int
+    restore_unlocks: int
+
 class Auditorium(BaseModel):
     number: int
     duration: Optional[int] = 60
@@ -0,0 +1,147 @@
+import asyncio
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta
+from sqlalchemy import delete
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.future import select
+from models import Base, AuditoriumEvent, AuditoriumUsageStats
+from database import engine, ensure_added_columns
+
+BUCKETS = ("day", "week")
+
+def bucket_start(moment, bucket):
+    day = datetime(moment.year, moment.month, moment.day)
+    if bucket == "week":
+        return day - timedelta(days=day.weekday())
+    return day
+
+def bucket_length(bucket):
+    return timedelta(days=7) if bucket == "week" else timedelta(days=1)
+
+def split_interval(start, end, bucket):
+    current = bucket_start(start, bucket)
+    while current < end:
+        next_start = current + bucket_length(bucket)
+        seconds = (min(end, next_start) - max(start, current)).total_seconds()
+        if seconds > 0:
+            yield current, seconds
+        current = next_start
+
+def _lock_deltas(timestamp):
+    for bucket in BUCKETS:
+        yield bucket, bucket_start(timestamp, bucket), "locks", 1
+
+def _unlock_deltas(locked_at, timestamp, reason):
+    for bucket in BUCKETS:
+        # Для блокировок, начатых до появления locked_at, длительность неизвестна.
+        if locked_at is not None:
+            for start, seconds in split_interval(locked_at, timestamp, bucket):
+                yield bucket, start, "locked_seconds", seconds
+        yield bucket, bucket_start(timestamp, bucket), f"{reason}_unlocks", 1
+
+async def _apply_deltas(session, auditorium_number, deltas):
+    table = AuditoriumUsageStats.__table__
+    for bucket, start, field, amount in deltas:
+        await session.execute(
+            insert(table)
+            .values(
+                auditorium_number=auditorium_number,
+                bucket=bucket,
+                bucket_start=start,
+                locked_seconds=0,
+                locks=0,
+                auto_unlocks=0,
+                manual_unlocks=0,
+                restore_unlocks=0,
+            )
+            .on_conflict_do_nothing(index_elements=["auditorium_number", "bucket", "bucket_start"])
+        )
+        # Инкремент на стороне базы, чтобы параллельные переходы не затирали друг друга.
+        await session.execute(
+            table.update()
+            .where(table.c.auditorium_number == auditorium_number)
+            .where(table.c.bucket == bucket)
+            .where(table.c.bucket_start == start)
+            .values({field: table.c[field] + amount})
+        )
+
+async def record_lock(session, auditorium_number, timestamp):
+    session.add(AuditoriumEvent(
+        auditorium_number=auditorium_number,
+        event="lock",
+        timestamp=timestamp,
+    ))
+    await _apply_deltas(session, auditorium_number, _lock_deltas(timestamp))
+
+async def record_unlock(session, auditorium_number, locked_at, timestamp, reason):
+    session.add(AuditoriumEvent(
+        auditorium_number=auditorium_number,
+        event="unlock",
+        reason=reason,
+        timestamp=timestamp,
+    ))
+    await _apply_deltas(session, auditorium_number, _unlock_deltas(locked_at, timestamp, reason))
+
+async def rebuild_stats():
+    totals = defaultdict(lambda: defaultdict(float))
+    open_locks = {}
+
+    # Чтение событий и замена таблицы идут в одной транзакции BEGIN IMMEDIATE:
+    # пока она открыта, переходы из работающего API ждут, а не теряются.
+    # Ожидание ограничено busy timeout SQLite (5 с), поэтому большую историю
+    # лучше пересчитывать при остановленном сервисе.
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.exec_driver_sql("BEGIN IMMEDIATE")
+        try:
+            result = await conn.execute(
+                select(AuditoriumEvent.__table__).order_by(AuditoriumEvent.timestamp, AuditoriumEvent.id)
+            )
+            for event in result:
+                number = event.auditorium_number
+                if event.event == "lock":
+                    if number in open_locks:
+                        continue
+                    open_locks[number] = event.timestamp
+                    deltas = _lock_deltas(event.timestamp)
+                else:
+                    deltas = _unlock_deltas(open_locks.pop(number, None), event.timestamp, event.reason)
+                for bucket, start, field, amount in deltas:
+                    totals[(number, bucket, start)][field] += amount
+
+            await conn.execute(delete(AuditoriumUsageStats))
+            if totals:
+                await conn.execute(
+                    AuditoriumUsageStats.__table__.insert(),
+                    [
+                        {
+                            "auditorium_number": number,
+                            "bucket": bucket,
+                            "bucket_start": start,
+                            "locked_seconds": values["locked_seconds"],
+                            "locks": int(values["locks"]),
+                            "auto_unlocks": int(values["auto_unlocks"]),
+                            "manual_unlocks": int(values["manual_unlocks"]),
+                            "restore_unlocks": int(values["restore_unlocks"]),
+                        }
+                        for (number, bucket, start), values in totals.items()
+                    ],
+                )
+            await conn.exec_driver_sql("COMMIT")
+        except BaseException:
+            await conn.exec_driver_sql("ROLLBACK")
+            raise
+
+    logging.info(f"Статистика пересчитана: {len(totals)} записей")
+
+async def main():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await ensure_added_columns(conn)
+    await rebuild_stats()
+    await engine.dispose()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    asyncio.run(main())
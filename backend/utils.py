@@ -1,16 +1,26 @@
 import subprocess
 import asyncio
 import os
-import signal
 import logging
+from collections import defaultdict
+from contextlib import asynccontextmanager
 from datetime import datetime
 from fastapi import HTTPException
 from models import AuditoriumState
 from database import SessionLocal
+from stats import record_unlock
 from sqlalchemy.future import select
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "30"))
+
+_draining = False
+_inflight_tasks = set()
+_scheduled_unlocks = set()
+# Playbook и изменение состояния одной аудитории выполняются строго по очереди.
+_auditorium_locks = defaultdict(asyncio.Lock)
+
 async def run_ansible_playbook(playbook_name, *, auditorium_number, class_number=None, state=None):
     playbook_path = f"./playbooks/{playbook_name}"
     
@@ -61,53 +71,153 @@ async def run_ansible_playbook(playbook_name, *, auditorium_number, class_number
             }
         }
 
-async def shutdown():
-    logging.info("Завершение работы сервера...")
-    tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
-    [task.cancel() for task in tasks]
+@asynccontextmanager
+async def firewall_operation():
+    if _draining:
+        raise HTTPException(status_code=503, detail="Сервер завершает работу, новые операции с firewall не принимаются")
 
+    task = asyncio.current_task()
+    _inflight_tasks.add(task)
     try:
-        await asyncio.gather(*tasks, return_exceptions=True)
-    except Exception as e:
-        logging.error(f"Ошибка при завершении задач")
+        yield
+    finally:
+        _inflight_tasks.discard(task)
+
+def auditorium_lock(auditorium_number):
+    return _auditorium_locks[auditorium_number]
+
+def schedule_auto_unlock(auditorium_number):
+    if _draining:
+        logging.info(f"Режим drain: разблокировка аудитории {auditorium_number} останется в базе для следующего экземпляра")
+        return
+
+    task = asyncio.create_task(auto_unlock_network(auditorium_number))
+    _scheduled_unlocks.add(task)
+    task.add_done_callback(_scheduled_unlocks.discard)
+
+async def restore_scheduled_unlocks():
+    async with SessionLocal() as session:
+        result = await session.execute(
+            select(AuditoriumState.auditorium_number)
+            .where(AuditoriumState.is_network_on.is_(False))
+            .where(AuditoriumState.unlock_time.is_not(None))
+        )
+        auditorium_numbers = result.scalars().all()
+
+    for number in auditorium_numbers:
+        schedule_auto_unlock(number)
+
+    if auditorium_numbers:
+        logging.info(f"Восстановлены запланированные разблокировки аудиторий: {auditorium_numbers}")
+
+async def drain(timeout=DRAIN_TIMEOUT):
+    global _draining
+    _draining = True
+    logging.info("Режим drain: новые операции с firewall не принимаются")
 
-    logging.info("Все фоновые задачи завершены.")
+    # Ожидающие разблокировки отменяем: unlock_time уже сохранено в базе,
+    # и следующий экземпляр подхватит их при старте.
+    sleeping = [t for t in _scheduled_unlocks if t not in _inflight_tasks]
+    for task in sleeping:
+        task.cancel()
+    await asyncio.gather(*sleeping, return_exceptions=True)
 
+    pending = [t for t in _inflight_tasks if t is not asyncio.current_task()]
+    if pending:
+        logging.info(f"Ожидание завершения {len(pending)} операций с firewall (не более {timeout} с)...")
+        _, still_running = await asyncio.wait(pending, timeout=timeout)
+        if still_running:
+            # Отменяем и дожидаемся оставшихся операций, чтобы они не работали
+            # с базой после закрытия engine.
+            logging.warning(f"{len(still_running)} операций с firewall не завершились за {timeout} с и будут отменены")
+            for task in still_running:
+                task.cancel()
+            await asyncio.gather(*still_running, return_exceptions=True)
+            return
 
-def signal_handler(sig, frame):
-    asyncio.create_task(shutdown())
+    logging.info("Все операции с firewall завершены.")
 
-signal.signal(signal.SIGINT, signal_handler)
-signal.signal(signal.SIGTERM, signal_handler)
+async def mark_unlocked(session, auditorium_number, reason, expected_unlock_time=None):
+    result = await session.execute(
+        select(AuditoriumState.locked_at)
+        .where(AuditoriumState.auditorium_number == auditorium_number)
+        .where(AuditoriumState.is_network_on.is_(False))
+    )
+    row = result.first()
+    if row is None:
+        return False
 
-async def auto_unlock_network(auditorium):
+    query = (
+        AuditoriumState.__table__.update()
+        .where(AuditoriumState.auditorium_number == auditorium_number)
+        .where(AuditoriumState.is_network_on.is_(False))
+        .where(AuditoriumState.locked_at.is_not_distinct_from(row.locked_at))
+        .values(is_network_on=True, unlock_time=None, locked_at=None)
+    )
+    if expected_unlock_time is not None:
+        query = query.where(AuditoriumState.unlock_time == expected_unlock_time)
+
+    result = await session.execute(query)
+    if result.rowcount == 0:
+        return False
+
+    await record_unlock(session, auditorium_number, row.locked_at, datetime.utcnow(), reason)
+    return True
+
+async def auto_unlock_network(auditorium_number):
     async with SessionLocal() as session:
+        result = await session.execute(
+            select(AuditoriumState.unlock_time)
+            .where(AuditoriumState.auditorium_number == auditorium_number)
+        )
+        unlock_time = result.scalar_one_or_none()
+
+    if unlock_time is None:
+        return
+
+    delay = (unlock_time - datetime.utcnow()).total_seconds()
+    if delay > 0:
         try:
-            result = await session.execute(
-                select(AuditoriumState)
-                .where(AuditoriumState.auditorium_number == auditorium.number)
-                .execution_options(populate_existing=True)
-            )
-            auditorium_state = result.scalar_one_or_none()
-            if not auditorium_state:
-                raise ValueError(f"Аудитория {auditorium.number} не найдена.")
-
-            current_time = datetime.utcnow()
-            if auditorium_state.unlock_time:
-                delay = (auditorium_state.unlock_time - current_time).total_seconds()
-                if delay > 0:
-                    try:
-                        await asyncio.sleep(delay)
-                    except asyncio.CancelledError:
-                        print(f"Задача разблокировки аудитории {auditorium.number} была отменена.")
-                        return
-
-            await run_ansible_playbook("network_on.yaml", auditorium.number)
-            auditorium_state.is_network_on = True
-            auditorium_state.unlock_time = None
-            await session.commit()
-        except Exception as e:
-            print(f"Ошибка разблокировки аудитории {auditorium.number}: {e}")
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            logging.info(f"Разблокировка аудитории {auditorium_number} отложена до следующего запуска сервера.")
+            return
+
+    # Сон закончился уже во время drain: unlock_time остаётся в базе для следующего экземпляра.
+    if _draining:
+        logging.info(f"Разблокировка аудитории {auditorium_number} отложена до следующего запуска сервера.")
+        return
+
+    try:
+        async with firewall_operation(), auditorium_lock(auditorium_number):
+            async with SessionLocal() as session:
+                result = await session.execute(
+                    select(AuditoriumState)
+                    .where(AuditoriumState.auditorium_number == auditorium_number)
+                    .execution_options(populate_existing=True)
+                )
+                auditorium_state = result.scalar_one_or_none()
+                if not auditorium_state:
+                    raise ValueError(f"Аудитория {auditorium_number} не найдена.")
+
+                # Аудиторию могли разблокировать вручную или заблокировать заново на другой срок.
+                if auditorium_state.is_network_on or auditorium_state.unlock_time is None \
+                        or auditorium_state.unlock_time > datetime.utcnow():
+                    return
+
+                observed_unlock_time = auditorium_state.unlock_time
+                await run_ansible_playbook("firewall.yml", auditorium_number=auditorium_number, class_number=auditorium_number, state="enabled")
+
+                # Пока выполнялся playbook, аудиторию могли заблокировать заново или разблокировать
+                # другим экземпляром, поэтому состояние меняем только если оно не изменилось.
+                if not await mark_unlocked(session, auditorium_number, "auto", expected_unlock_time=observed_unlock_time):
+                    await session.rollback()
+                    logging.info(f"Состояние аудитории {auditorium_number} изменилось во время разблокировки, пропускаем.")
+                    return
+
+                await session.commit()
+    except Exception as e:
+        logging.error(f"Ошибка разблокировки аудитории {auditorium_number}: {e}")
 
 async def initialize_auditoriums(conn):
     auditoriums = [11, 14, 15, 17, 19, 20, 23, 24, 103, 113, 262]